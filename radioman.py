@@ -4,10 +4,14 @@ from __future__ import print_function
 # Make sure rpctools is installed for whichever version
 from rpctools.jsonrpc import ServerProxy
 from termcolor import cprint, colored
+from multiprocessing.pool import ThreadPool
 import functools
+from collections import deque
 import datetime
 import readline
+import curses
 import json
+import os
 import time
 import sys
 import re
@@ -23,6 +27,8 @@ UNLIMITED = None
 
 BARCODE_RE = re.compile('^[A-Za-z0-9+=-]{6}$')
 
+LOG_SEPARATOR_RE = re.compile(r'(?<!\\),')
+
 CHECKED_IN = 'CHECKED_IN'
 CHECKED_OUT = 'CHECKED_OUT'
 
@@ -47,6 +53,8 @@ HEADSETS = 0
 
 UBER = None
 
+VERSIONS = {'radios': 0, 'limits': 0}
+
 class RadioNotFound(Exception):
     pass
 
@@ -74,31 +82,84 @@ class DepartmentOverLimit(OverrideException):
 class WrongPerson(OverrideException):
     override = ALLOW_WRONG_PERSON
 
+def radio_key(id):
+    return str(id).strip()
+
+def dept_key(name):
+    return str(name).strip().lower()
+
+def invalidate(name):
+    VERSIONS[name] += 1
+
+class OptionSet(object):
+    # Caches normalized keys of a collection until VERSIONS[name] is bumped
+    def __init__(self, name, source, normalize):
+        self.name = name
+        self.source = source
+        self.normalize = normalize
+        self.version = None
+        self.index = {}
+
+    def sync(self):
+        if self.version != VERSIONS[self.name]:
+            self.index = dict((self.normalize(key), key) for key in self.source())
+            self.version = VERSIONS[self.name]
+
+    def add(self, key):
+        self.sync()
+        self.index[self.normalize(key)] = key
+
+    def get(self, value, default=None):
+        self.sync()
+        return self.index.get(self.normalize(value), default)
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def __len__(self):
+        self.sync()
+        return len(self.index)
+
+def log_line(fields):
+    return ','.join(('' if f is None else str(f).replace(',', '\\,') for f in fields)) + '\n'
+
+def parse_log_line(line):
+    return [field.replace('\\,', ',') for field in LOG_SEPARATOR_RE.split(line.rstrip('\n'))]
+
 def log(*fields):
     logfile = CONFIG.get('log', 'radios.log')
     with open(logfile, 'a+') as f:
-        f.write(','.join((str(f) for f in fields)) + '\n')
+        f.write(log_line(fields))
 
 def log_audit(*fields):
     logfile = CONFIG.get('audit_log', 'audits.log')
     with open(logfile, 'a+') as f:
-        f.write(','.join((str(f) for f in fields)) + '\n')
-
-def load_db():
-    data = {}
-    radiofile = CONFIG.get('db', 'radios.json')
-    try:
-        with open(radiofile) as f:
-            data = json.load(f)
-        global HEADSETS, AUDIT_LOG, RADIOS
-
-        RADIOS = data.get('radios', {})
+        f.write(log_line(fields))
+
+def new_radio():
+    return {
+        'status': CHECKED_IN,
+        'last_activity': 0,
+        'history': [{'status': CHECKED_IN,
+                     'department': None,
+                     'borrower': None,
+                     'badge': None,
+                     'headset': None,
+                     'time': 0,
+        }],
+        'checkout': {
+            'status': CHECKED_IN,
+            'department': None,
+            'borrower': None,
+            'badge': None,
+            'headset': None,
+            'time': 0,
+        },
+    }
 
-        HEADSETS = data.get('headsets', 0)
-        AUDIT_LOG = data.get('audits', [])
-    except FileNotFoundError:
-        with open(radiofile, 'w') as f:
-            json.dump({}, f)
+def read_db(radiofile):
+    with open(radiofile) as f:
+        return json.load(f)
 
 def save_db():
     with open(CONFIG.get('db', 'radios.json'), 'w') as f:
@@ -113,7 +174,7 @@ def apply_audit(override, radio, borrower, lender, description=''):
         'type': override,
         'description': description,
     })
-    log_audit(override, time.time(), radio, borrower, lender, description.replace(',', '\\,'))
+    log_audit(override, time.time(), radio, borrower, lender, description)
 
     global LAST_OPER
     LAST_OPER = lender
@@ -212,36 +273,18 @@ def return_radio(id, headset, barcode=None, name=None, badge=None, overrides=[])
         raise RadioNotFound("Radio does not exist")
 
 def configure(f):
-    global CONFIG, RADIOS
-    with open(f) as conf:
-        CONFIG.update(json.load(conf))
-
-    load_db()
-
-    for radio in CONFIG.get('radios', []):
-        if str(radio) not in RADIOS:
-            RADIOS[radio] = {
-                'status': CHECKED_IN,
-                'last_activity': 0,
-                'history': [{'status': CHECKED_IN,
-                             'department': None,
-                             'borrower': None,
-                             'badge': None,
-                             'headset': None,
-                             'time': 0,
-                }],
-                'checkout': {
-                    'status': CHECKED_IN,
-                    'department': None,
-                    'borrower': None,
-                    'badge': None,
-                    'headset': None,
-                    'time': 0,
-                },
-            }
+    global RADIOS, HEADSETS, AUDIT_LOG
+    shard = Shard(f).load()
+
+    CONFIG.update(shard.config)
 
-    for name, dept in CONFIG.get('departments', {}).items():
-        LIMITS[name] = dept.get('limit', UNLIMITED)
+    RADIOS = shard.radios
+    HEADSETS = shard.headsets
+    AUDIT_LOG = shard.audits
+    invalidate('radios')
+
+    LIMITS.update(shard.limits)
+    invalidate('limits')
 
     save_db()
 
@@ -284,6 +327,9 @@ def get_value(prompt, errmsg, completer=None, options=None, validator=None, fix=
                 cprint('Please enter a value.', 'yellow')
                 continue
 
+        if isinstance(options, OptionSet):
+            value = options.get(value, value)
+
         if (not options or value in options) and \
            (not validator or validator(value)):
             return value
@@ -293,15 +339,17 @@ def get_value(prompt, errmsg, completer=None, options=None, validator=None, fix=
                     cprint(errmsg, 'red')
                     do_fix = get_value(colored(fixmsg, 'yellow'), 'Please enter \'y\' or \'n\'.', validator=lambda v: v and v.lower()[:1] in ('y', 'n'))
 
-                    if do_fix.startswith('y'):
-                        fix(value)
-                        return value
-                else:
-                    fix(value)
-                    return value
+                    if not do_fix.startswith('y'):
+                        continue
+
+                fix(value)
+                if isinstance(options, OptionSet):
+                    value = options.get(value, value)
+                return value
 
 def add_dept(name):
     LIMITS[name] = None
+    DEPT_OPTIONS.add(name)
 
 def complete(items, text, state):
     valid = [item for item in (items() if callable(items) else items) if any((
@@ -311,26 +359,13 @@ def complete(items, text, state):
         return valid[state][valid[state].lower().find(text.lower()):]
 
 def add_radio(id):
-    if id not in RADIOS:
-        RADIOS[id] = {
-            'status': CHECKED_IN,
-            'last_activity': 0,
-            'history': [{'status': CHECKED_IN,
-                         'department': None,
-                         'borrower': None,
-                         'badge': None,
-                         'headset': None,
-                         'time': 0,
-            }],
-            'checkout': {
-                'status': CHECKED_IN,
-                'department': None,
-                'borrower': None,
-                'badge': None,
-                'headset': None,
-                'time': 0,
-            },
-        }
+    if RADIO_OPTIONS.get(id) is None:
+        id = radio_key(id)
+        RADIOS[id] = new_radio()
+        RADIO_OPTIONS.add(id)
+
+RADIO_OPTIONS = OptionSet('radios', lambda: RADIOS, radio_key)
+DEPT_OPTIONS = OptionSet('limits', lambda: LIMITS, dept_key)
 
 complete_dept = functools.partial(complete, LIMITS.keys)
 complete_person = functools.partial(complete, [
@@ -342,11 +377,11 @@ complete_radios = functools.partial(complete, RADIOS.keys)
 
 get_bool = lambda q: get_value(prompt=q, errmsg='Please enter \'y\' or \'n\'.', validator=lambda v: v and v.lower()[:1] in ('y', 'n'), default='n').lower().startswith('y')
 get_headset = functools.partial(get_bool, 'Headset? (y/n) ')
-get_radio = functools.partial(get_value, 'Radio ID: ', errmsg='Radio does not exist!', completer=complete_in_radios, options=lambda: RADIOS.keys(), fix=add_radio)
-get_out_radio = functools.partial(get_value, 'Radio ID: ', 'Radio does not exist!', complete_out_radios, lambda: RADIOS.keys(), fix=add_radio, fixmsg='Add this radio? (y/n) ')
+get_radio = functools.partial(get_value, 'Radio ID: ', errmsg='Radio does not exist!', completer=complete_in_radios, options=RADIO_OPTIONS, fix=add_radio)
+get_out_radio = functools.partial(get_value, 'Radio ID: ', 'Radio does not exist!', complete_out_radios, RADIO_OPTIONS, fix=add_radio, fixmsg='Add this radio? (y/n) ')
 get_person = functools.partial(get_value, 'Name or barcode (skip for department): ', 'Enter a name!', complete_person)
 get_operator = functools.partial(get_value, lambda: 'Your name [' + (LAST_OPER or '') + ']: ', 'Enter your name!', complete_operator, empty=True, default=lambda: LAST_OPER)
-get_dept = functools.partial(get_value, 'Department: ', 'That department does not exist!', complete_dept, lambda: LIMITS.keys(), fix=add_dept, fixmsg='Add new department? ', empty=True)
+get_dept = functools.partial(get_value, 'Department: ', 'That department does not exist!', complete_dept, DEPT_OPTIONS, fix=add_dept, fixmsg='Add new department? ', empty=True)
 get_desc = functools.partial(get_value, 'Describe why, if necessary: ', '', None, empty=True)
 
 def lookup_badge(barcode):
@@ -464,6 +499,382 @@ def radio_status():
 
     return True
 
+class Shard(object):
+    def __init__(self, conf_file):
+        self.conf_file = conf_file
+        self.config = {}
+        self.radios = {}
+        self.limits = {}
+        self.headsets = 0
+        self.audits = []
+        self.out = 0
+        self.departments = {}
+        self.locations = {}
+
+    @property
+    def name(self):
+        return self.config.get('name') or \
+            os.path.basename(os.path.dirname(os.path.abspath(self.conf_file))) or self.conf_file
+
+    def load(self):
+        # Loading never writes anything; configure() saves the db for the desk.
+        # Relative paths are taken from the working directory, same as the desk,
+        # so sites that share a directory need absolute db/log paths
+        with open(self.conf_file) as conf:
+            self.config = json.load(conf)
+
+        try:
+            data = read_db(self.config.get('db', 'radios.json'))
+        except FileNotFoundError:
+            data = {}
+
+        self.radios = data.get('radios', {})
+        self.headsets = data.get('headsets', 0)
+        self.audits = data.get('audits', [])
+
+        for radio in self.config.get('radios', []):
+            if radio_key(radio) not in self.radios:
+                self.radios[radio_key(radio)] = new_radio()
+
+        for name, dept in self.config.get('departments', {}).items():
+            self.limits[name] = dept.get('limit', UNLIMITED)
+
+        self.summarize()
+        return self
+
+    def summarize(self):
+        # Only the current checkout of each radio matters, never its history
+        self.out = 0
+        self.departments = {}
+        self.locations = {}
+        for id, radio in self.radios.items():
+            self.locations[radio_key(id)] = radio['status']
+            if radio['status'] == CHECKED_OUT:
+                dept = radio['checkout']['department']
+                radio_count, headset_count = self.departments.get(dept, (0, 0))
+                self.departments[dept] = (radio_count + 1,
+                                          headset_count + (1 if radio['checkout']['headset'] else 0))
+                self.out += 1
+
+class Sites(object):
+    def __init__(self, conf_files):
+        self.shards = [Shard(f) for f in conf_files]
+
+    def load(self):
+        pool = ThreadPool(min(len(self.shards), 8) or 1)
+        try:
+            pool.map(Shard.load, self.shards)
+        finally:
+            pool.close()
+            pool.join()
+        return self
+
+    def radios_out(self):
+        return sum(shard.out for shard in self.shards)
+
+    def department_totals(self):
+        # Departments are matched case-insensitively; the first spelling seen is shown
+        names = {}
+        totals = {}
+        for shard in self.shards:
+            for dept, (radio_count, headset_count) in shard.departments.items():
+                key = dept_key(dept or '')
+                names.setdefault(key, dept)
+                radios, headsets = totals.get(key, (0, 0))
+                totals[key] = (radios + radio_count, headsets + headset_count)
+        return dict((names[key], counts) for key, counts in totals.items())
+
+    def locate(self, id):
+        return [(shard.name, shard.locations[radio_key(id)]) for shard in self.shards
+                if radio_key(id) in shard.locations]
+
+    def duplicates(self):
+        seen = {}
+        for shard in self.shards:
+            for id in shard.locations:
+                seen[id] = seen.get(id, 0) + 1
+        return sorted((id for id, count in seen.items() if count > 1), key=lambda k: (len(k), k))
+
+def sites_status(sites):
+    print('{0:20s}   {1:>6s}   {2:>6s}   {3:>9s}'.format('Site', 'Radios', 'Out', 'Headsets'))
+    for shard in sites.shards:
+        print('{0:20s}   {1:6d}   {2:6d}   {3:>9s}'.format(
+            shard.name,
+            len(shard.radios),
+            shard.out,
+            '{} / {}'.format(shard.headsets, shard.config.get('headsets', 0)),
+        ))
+    cprint('Total radios out: {}'.format(sites.radios_out()), attrs=['bold'])
+    print()
+
+    print('{0:20s}   {1:>6s}   {2:>8s}'.format('Department', 'Radios', 'Headsets'))
+    for dept, (radio_count, headset_count) in sorted(sites.department_totals().items(),
+                                                     key=lambda k: k[0] or ''):
+        print('{0:20s}   {1:6d}   {2:8d}'.format(dept or '-', radio_count, headset_count))
+
+    duplicates = sites.duplicates()
+    if duplicates:
+        print()
+        cprint('Radios listed at more than one site:', 'yellow')
+        for id in duplicates:
+            print('{0:>3s}   {1}'.format(id, ', '.join(
+                '{} ({})'.format(name, colored(status.replace('_', ' ').title(),
+                                               'green' if status == CHECKED_IN else 'red'))
+                for name, status in sites.locate(id))))
+
+    return True
+
+class Dashboard(object):
+    TICKER = 5
+
+    def __init__(self, screen, shard):
+        self.screen = screen
+        self.shard = shard
+        self.logs = {
+            shard.config.get('log', 'radios.log'): self.apply_radio_event,
+            shard.config.get('audit_log', 'audits.log'): self.apply_audit_event,
+        }
+        self.drawn = {}
+        self.top = 0
+        self.page = 1
+        self.reset()
+
+    def reset(self):
+        shard = self.shard
+        self.radios = shard.radios
+        self.ids = sorted(self.radios, key=lambda k: (len(k), k))
+        self.headsets = shard.headsets
+        self.usage = dict((dept, list(counts)) for dept, counts in shard.departments.items())
+        self.overrides = deque(shard.audits[-self.TICKER:], maxlen=self.TICKER)
+        # Start at the end of each log; the db already holds everything before it
+        self.offsets = {}
+        for logfile in self.logs:
+            try:
+                self.offsets[logfile] = os.path.getsize(logfile)
+            except OSError:
+                self.offsets[logfile] = 0
+        self.changed = True
+
+    def follow(self, logfile):
+        try:
+            size = os.path.getsize(logfile)
+        except OSError:
+            return []
+
+        offset = self.offsets[logfile]
+        if size < offset:
+            # Log was truncated or rotated; its old lines are already in the db,
+            # so reload from there instead of replaying the new file
+            try:
+                self.shard.load()
+            except ValueError:
+                # The desk is in the middle of rewriting the db; try again next poll
+                return []
+            self.reset()
+            return []
+        if size == offset:
+            return []
+
+        with open(logfile, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+
+        # Leave a partially written line for the next pass
+        end = data.rfind(b'\n') + 1
+        self.offsets[logfile] = offset + end
+        return [parse_log_line(line.decode('utf-8', 'replace')) for line in data[:end].splitlines()]
+
+    def poll(self):
+        for logfile, apply_event in self.logs.items():
+            for fields in self.follow(logfile):
+                apply_event(fields)
+                self.changed = True
+
+    def count(self, radio, sign):
+        checkout = radio['checkout']
+        counts = self.usage.setdefault(checkout['department'], [0, 0])
+        counts[0] += sign
+        counts[1] += sign if checkout['headset'] else 0
+
+    def apply_radio_event(self, fields):
+        if len(fields) < 7:
+            return
+
+        status, when, id, name, badge, dept, headset = fields[:7]
+        headset = headset == 'True'
+
+        if id not in self.radios:
+            self.radios[id] = new_radio()
+            self.ids = sorted(self.radios, key=lambda k: (len(k), k))
+
+        radio = self.radios[id]
+        if radio['status'] == CHECKED_OUT:
+            self.count(radio, -1)
+
+        radio['status'] = status
+        radio['last_activity'] = float(when)
+        if status == CHECKED_OUT:
+            radio['checkout'] = {
+                'status': status,
+                'time': radio['last_activity'],
+                'borrower': name or None,
+                'department': dept,
+                'badge': badge or None,
+                'headset': headset,
+            }
+            self.count(radio, 1)
+            if headset:
+                self.headsets -= 1
+        else:
+            radio['checkout'] = {
+                'status': status,
+                'time': radio['last_activity'],
+                'borrower': None,
+                'department': None,
+                'badge': None,
+                'headset': None,
+            }
+            if headset:
+                self.headsets += 1
+
+    def apply_audit_event(self, fields):
+        if len(fields) < 6:
+            return
+
+        override, when, radio, borrower, lender, description = fields[:6]
+        self.overrides.append({
+            'time': float(when),
+            'radio': radio,
+            'borrower': borrower,
+            'lender': lender,
+            'type': override,
+            'description': description,
+        })
+
+    def put(self, y, segments):
+        # Only touch screen lines whose contents actually changed
+        if self.drawn.get(y) == segments:
+            return
+        self.drawn[y] = segments
+
+        height, width = self.screen.getmaxyx()
+        if y >= height:
+            return
+
+        self.screen.move(y, 0)
+        self.screen.clrtoeol()
+        x = 0
+        for text, attr in segments:
+            if x >= width - 1:
+                break
+            self.screen.addstr(y, x, text[:width - 1 - x], attr)
+            x += len(text)
+
+    def header(self):
+        red, yellow = curses.color_pair(2), curses.color_pair(3)
+        lines = []
+
+        lines.append([('Headsets: {} / {}'.format(self.headsets, self.shard.config.get('headsets', 0)),
+                       curses.A_BOLD | (red if self.headsets <= 0 else 0))])
+
+        lines.append([('{0:20s}   {1:>6s}   {2:>8s}   {3:>5s}'.format('Department', 'Radios', 'Headsets', 'Limit'), curses.A_BOLD)])
+        for dept in sorted(set(self.shard.limits) | set(d for d in self.usage if d)):
+            radio_count, headset_count = self.usage.get(dept, (0, 0))
+            limit = self.shard.limits.get(dept, UNLIMITED)
+            lines.append([('{0:20s}   {1:6d}   {2:8d}   {3:>5s}'.format(
+                dept, radio_count, headset_count, '-' if limit == UNLIMITED else str(limit)),
+                red if limit != UNLIMITED and headset_count >= limit else 0)])
+
+        lines.append([('Recent overrides', curses.A_BOLD)])
+        for i in range(self.TICKER):
+            if i < len(self.overrides):
+                audit = self.overrides[-1 - i]
+                lines.append([('{0:10s}   #{1:>3s}   {2:27s}   {3}: {4}'.format(
+                    datetime.datetime.fromtimestamp(audit['time']).strftime('%H:%M %a'),
+                    str(audit['radio']),
+                    audit['type'].replace('_', ' ').title(),
+                    audit['lender'] or '-',
+                    audit['description'] or '-',
+                ), yellow)])
+            else:
+                lines.append([])
+
+        lines.append([('{0:3s}   {1:11s}   {2:10s}   {3:15s}   {4:20s}   {5:7s}'.format(
+            'ID', 'Status', 'Since', 'Department', 'Name', 'Headset'), curses.A_BOLD)])
+        return lines
+
+    def row(self, id):
+        status = self.radios[id]
+        return [
+            ('{0:>3s}   '.format(id), 0),
+            ('{0:11s}'.format(status['status'].replace('_', ' ').title()),
+             curses.color_pair(1) if status['status'] == CHECKED_IN else curses.color_pair(2)),
+            ('   {0:10s}   {1:15s}   {2:20s}   {3:7s}'.format(
+                datetime.datetime.fromtimestamp(status['last_activity']).strftime('%H:%M %a') if status['last_activity'] else '-',
+                status['checkout']['department'] or '-',
+                status['checkout']['borrower'] or '-',
+                'Yes' if status['checkout'].get('headset') else 'No',
+            ), 0),
+        ]
+
+    def redraw(self):
+        lines = self.header()
+
+        # Only the radios that fit on screen are ever formatted
+        self.page = max(self.screen.getmaxyx()[0] - len(lines), 1)
+        self.top = max(min(self.top, len(self.ids) - self.page), 0)
+        lines.extend(self.row(id) for id in self.ids[self.top:self.top + self.page])
+
+        for y, segments in enumerate(lines):
+            self.put(y, segments)
+        for stale in [y for y in self.drawn if y >= len(lines)]:
+            self.put(stale, [])
+            del self.drawn[stale]
+
+        self.screen.refresh()
+        self.changed = False
+
+    def scroll(self, key):
+        moves = {
+            curses.KEY_UP: -1,
+            curses.KEY_DOWN: 1,
+            curses.KEY_PPAGE: -self.page,
+            curses.KEY_NPAGE: self.page,
+            curses.KEY_HOME: -len(self.ids),
+            curses.KEY_END: len(self.ids),
+        }
+        if key in moves:
+            self.top += moves[key]
+            self.changed = True
+
+    def run(self):
+        curses.curs_set(0)
+        curses.use_default_colors()
+        curses.init_pair(1, curses.COLOR_GREEN, -1)
+        curses.init_pair(2, curses.COLOR_RED, -1)
+        curses.init_pair(3, curses.COLOR_YELLOW, -1)
+        # Block for input between log checks so an idle floor costs nothing
+        self.screen.timeout(1000)
+
+        while True:
+            self.poll()
+            if self.changed:
+                self.redraw()
+
+            key = self.screen.getch()
+            if key in (ord('q'), ord('Q'), ord('x'), ord('X')):
+                return
+            elif key == curses.KEY_RESIZE:
+                self.screen.clear()
+                self.drawn = {}
+                self.changed = True
+            elif key != -1:
+                self.scroll(key)
+
+def dashboard(conf_file):
+    shard = Shard(conf_file).load()
+    curses.wrapper(lambda screen: Dashboard(screen, shard).run())
+
 def main_menu():
     cprint("===== Actions =====", 'blue')
     print(" {0}. Check Out Radio".format(colored('1', 'cyan')))
@@ -498,6 +909,25 @@ complete_actions = functools.partial(complete, ACTIONS.keys)
 get_action = functools.partial(get_value, '> ', 'Action not found. Type \'?\' for help.', complete_actions, options=ACTIONS.keys)
 
 def main():
+    if sys.argv[1:2] == ['--sites']:
+        try:
+            sites_status(Sites(sys.argv[2:]).load())
+        except FileNotFoundError as e:
+            cprint('Config is not found -- make sure {} exists'.format(e.filename), 'red')
+        sys.exit()
+
+    if sys.argv[1:2] == ['--dashboard']:
+        conf_file = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] else 'config.json'
+        try:
+            dashboard(conf_file)
+        except FileNotFoundError:
+            cprint('Config is not found -- make sure {} exists; see config.json.example for help'.format(conf_file), 'red')
+        except ValueError as e:
+            cprint('Unable to read radio data, try again in a moment: {}'.format(e), 'red')
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
     conf_file = 'config.json'
     if len(sys.argv) > 1:
         if sys.argv[1]: